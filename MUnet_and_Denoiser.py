@@ -8,9 +8,10 @@ from models.Denoiser import DenoiserUNet
 class DocDiff(nn.Module):
     def __init__(self, input_channels: int = 2, output_channels: int = 1, n_channels: int = 32,
                  ch_mults: Union[Tuple[int, ...], List[int]] = (1, 2, 2, 4),
-                 n_blocks: int = 1):
+                 n_blocks: int = 1, channels_last: bool = False):
         super(DocDiff, self).__init__()
-        self.denoiser = DenoiserUNet(input_channels, output_channels, n_channels, ch_mults, n_blocks, is_noise=True)
+        self.denoiser = DenoiserUNet(input_channels, output_channels, n_channels, ch_mults, n_blocks, is_noise=True,
+                                     channels_last=channels_last)
         self.init_predictor = MIMOUNet(num_res=16)
         # self.init_predictor = UNet(input_channels, output_channels, 2 * n_channels, ch_mults, n_blocks)
         # 这里的结构略有疑惑，首先就是对于输入的文档图像究竟是几通道图像，以我现在的认知，我暂时认为输入的文档图像都是灰度图，即1通道
@@ -1,34 +1,52 @@
 import math
 from typing import Tuple, Union, List
-import numpy as np
 import torch
 from torch import nn
-from models.Stripformer_Attention import Stripformer
-from einops import rearrange
+import torch.nn.functional as F
+from models.Stripformer_Attention import Stripformer, Intra_SA, Inter_SA
+
+
+class LayerNorm2d(nn.LayerNorm):
+    """
+    `nn.LayerNorm` over the channel dimension of a `[batch_size, channels, height, width]` tensor.
+    Runs the fused `layer_norm` kernel on a channels-last view; that view needs no copy when the
+    input is stored in `channels_last` format
+    """
+
+    def forward(self, x: torch.Tensor):
+        x = F.layer_norm(x.permute(0, 2, 3, 1), self.normalized_shape, self.weight, self.bias, self.eps)
+        return x.permute(0, 3, 1, 2)
 
 
 class MLP(nn.Module):
     def __init__(self, embedding_size, forward_expansion=2):
         super(MLP, self).__init__()
         self.conv = nn.Conv2d(in_channels=embedding_size, out_channels=embedding_size, kernel_size=3, padding=1)
+        # Per-pixel LayerNorm + Linear, written as channel LayerNorm + 1x1 conv so the feature map is not rearranged
         self.fc = nn.Sequential(
-            nn.LayerNorm(embedding_size),
-            nn.Linear(embedding_size, forward_expansion * embedding_size),
-            nn.ReLU(),
-            nn.Linear(forward_expansion * embedding_size, embedding_size),
-            nn.LayerNorm(embedding_size)
+            LayerNorm2d(embedding_size),
+            nn.Conv2d(embedding_size, forward_expansion * embedding_size, kernel_size=1),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(forward_expansion * embedding_size, embedding_size, kernel_size=1),
+            LayerNorm2d(embedding_size)
         )
+        self.conv_out = nn.Conv2d(in_channels=embedding_size, out_channels=embedding_size, kernel_size=3, padding=1)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints applied `conv` on both sides of `fc`, so `conv_out` starts from the same weights
+        for name in ('weight', 'bias'):
+            if prefix + 'conv_out.' + name not in state_dict and prefix + 'conv.' + name in state_dict:
+                state_dict[prefix + 'conv_out.' + name] = state_dict[prefix + 'conv.' + name]
+        # `fc` used to hold `nn.Linear` layers, whose weights are the 1x1 conv weights without the spatial dims
+        for key in (prefix + 'fc.1.weight', prefix + 'fc.3.weight'):
+            if key in state_dict and state_dict[key].dim() == 2:
+                state_dict[key] = state_dict[key][:, :, None, None]
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x):
-        self.fc.to(x.device)
-        self.conv.to(x.device)
-        B, C, H, W = x.shape
-
         hx = self.conv(x)
-        hx = rearrange(hx, 'b c h w -> b (h w) c')
         hx = self.fc(hx)
-        hx = rearrange(hx, 'b (h w) c -> b c h w', h=H, w=W)
-        hx = self.conv(hx)
+        hx = self.conv_out(hx)
         # print('在运行MLP')
 
         return hx + x
@@ -38,9 +56,50 @@ def Normalize(in_channels):
     return torch.nn.GroupNorm(num_groups=32, num_channels=in_channels, eps=1e-6, affine=True)
 
 
-class Swish(nn.Module):
-    def forward(self, x):
-        return x * torch.sigmoid(x)
+@torch.no_grad()
+def fold_norm_affine(norm: nn.LayerNorm, layer: nn.Module):
+    """
+    Folds the affine `weight`/`bias` of `norm` into the 1x1 conv or linear `layer` that directly consumes
+    its output, then removes the affine from `norm`: `W (gamma * x + beta) + b = (W * gamma) x + (W beta + b)`
+    """
+    if norm.weight is None:
+        return
+    weight = layer.weight.view(layer.weight.shape[0], -1)
+    layer.bias.add_(weight @ norm.bias)
+    weight.mul_(norm.weight)
+    norm.weight = None
+    norm.bias = None
+    norm.elementwise_affine = False
+
+
+def add_group_norm(h: torch.Tensor, bias: torch.Tensor, norm: nn.GroupNorm):
+    """
+    Computes `norm(h + bias[:, :, None, None])` without writing `h + bias` back to memory.
+    The group statistics are put together from per-channel statistics of `h`, then the
+    bias, normalization and affine collapse into one per-channel scale and shift over `h`.
+    * `h` has shape `[batch_size, channels, height, width]`
+    * `bias` has shape `[batch_size, channels]`
+    """
+    B, C = bias.shape
+    G = norm.num_groups
+    var, mean = torch.var_mean(h, dim=(2, 3), unbiased=False)
+    # Adding a per-channel constant only moves the channel mean
+    mean = (mean.float() + bias.float()).view(B, G, -1)
+    var = var.float().view(B, G, -1)
+    group_mean = mean.mean(dim=2, keepdim=True)
+    group_var = var.mean(dim=2, keepdim=True) + (mean - group_mean).pow(2).mean(dim=2, keepdim=True)
+
+    scale = torch.rsqrt(group_var + norm.eps).expand_as(mean)
+    if norm.weight is not None:
+        scale = scale * norm.weight.float().view(1, G, -1)
+    shift = (bias.float().view(B, G, -1) - group_mean) * scale
+    if norm.bias is not None:
+        shift = shift + norm.bias.float().view(1, G, -1)
+    return torch.addcmul(shift.reshape(B, C, 1, 1).to(h.dtype), h, scale.reshape(B, C, 1, 1).to(h.dtype))
+
+
+# `x * sigmoid(x)`; `nn.SiLU` runs it as a single fused elementwise kernel
+Swish = nn.SiLU
 
 
 class TimeEmbedding(nn.Module):
@@ -55,12 +114,50 @@ class TimeEmbedding(nn.Module):
         # Second linear layer
         self.lin2 = nn.Linear(self.n_channels, self.n_channels)
 
-    def forward(self, t: torch.Tensor):
+        # Sinusoidal frequencies are constant, so build them once instead of on every step.
+        # Each frequency appears twice, the second copy with a phase of pi/2 so that sin gives the cos half
+        # and `[sin, cos]` comes out of one kernel without a concatenation.
+        # Not persistent, so existing checkpoints still load
         half_dim = self.n_channels // 8
         emb = math.log(10_000) / (half_dim - 1)
-        emb = torch.exp(torch.arange(half_dim, device=t.device) * -emb)
-        emb = t[:, None] * emb[None, :]
-        emb = torch.cat((emb.sin(), emb.cos()), dim=1)
+        freqs = torch.exp(torch.arange(half_dim) * -emb)
+        self.register_buffer('freqs', torch.cat((freqs, freqs)), persistent=False)
+        self.register_buffer('phase', torch.cat((torch.zeros(half_dim), torch.full((half_dim,), math.pi / 2))),
+                             persistent=False)
+        # Embeddings of all integer time steps, filled by `materialize` for inference
+        self.register_buffer('table', None, persistent=False)
+
+    def _apply(self, fn, *args, **kwargs):
+        # Keep the frequencies in fp32 when the module is cast to bf16, the angles t * freqs need the precision.
+        # Take them before the cast and only move them, converting back afterwards would keep the bf16 rounding
+        freqs, phase = self.freqs, self.phase
+        super()._apply(fn, *args, **kwargs)
+        self.freqs = freqs.to(self.freqs.device)
+        self.phase = phase.to(self.phase.device)
+        return self
+
+    @torch.no_grad()
+    def materialize(self, T: int):
+        """
+        Precompute the embeddings of the time steps `0..T-1` so that `forward` is a table lookup in eval mode.
+        Call it again after the weights change; switching back to training mode drops the table.
+        """
+        self.table = None
+        self.table = self.forward(torch.arange(T, device=self.freqs.device))
+        return self
+
+    def train(self, mode: bool = True):
+        if mode:
+            self.table = None
+        return super().train(mode)
+
+    def forward(self, t: torch.Tensor):
+        # Continuous time steps (e.g. from DPM-Solver) fall through to the full computation
+        if self.table is not None and not self.training and not torch.is_floating_point(t):
+            return F.embedding(t, self.table)
+
+        # sin(t * f) for the first half and sin(t * f + pi/2) = cos(t * f) for the second
+        emb = torch.sin(torch.addcmul(self.phase, t[:, None].float(), self.freqs)).to(self.lin1.weight.dtype)
 
         # Transform with the MLP
         emb = self.act(self.lin1(emb))
@@ -82,14 +179,15 @@ class ResidualBlock(nn.Module):
         super().__init__()
         # Group normalization and the first convolution layer
         self.is_noise = is_noise
-        self.act1 = Swish()
+        # The normalized tensors are not reused, so the activations can run in place
+        self.act1 = Swish(inplace=True)
         self.norm1 = Normalize(in_channels=in_channels)
         self.conv1 = nn.Conv2d(in_channels, out_channels, kernel_size=(3, 3), padding=(1, 1))
 
         # Group normalization and the second convolution layer
 
         self.norm2 = Normalize(in_channels=out_channels)
-        self.act2 = Swish()
+        self.act2 = Swish(inplace=True)
         self.conv2 = nn.Conv2d(out_channels, out_channels, kernel_size=(3, 3), padding=(1, 1))
 
         # If the number of input channels is not equal to the number of output channels we have to
@@ -115,15 +213,18 @@ class ResidualBlock(nn.Module):
         # First convolution layer
         h = self.norm1(x)
         h = self.conv1(self.act1(h))
-        # Add time embeddings
+        # Add time embeddings and apply the second group normalization in one pass over `h`
         if self.is_noise:
-            h += self.time_emb(self.time_act(t))[:, :, None, None]
+            h = add_group_norm(h, self.time_emb(self.time_act(t)), self.norm2)
+        else:
+            h = self.norm2(h)
         # Second convolution layer
-        h = self.norm2(h)
         h = self.conv2(self.dropout(self.act2(h)))
 
-        # Add the shortcut connection and return
-        return h + self.shortcut(x)
+        # Add the shortcut connection into the conv2 output in place and return.
+        # Nothing else holds `h` (convolution backward does not need its output), so no extra output tensor is allocated
+        h += self.shortcut(x)
+        return h
 
 
 class DownBlock(nn.Module):
@@ -183,6 +284,9 @@ class MiddleBlock(nn.Module):
     def __init__(self, n_channels: int, time_channels: int, is_noise: bool = True):
         super().__init__()
         self.res1 = ResidualBlock(n_channels, n_channels, time_channels, is_noise=is_noise)
+        # dia1/dia2 (and dia3/dia4) are linear and back to back, but are deliberately not merged into one conv:
+        # the composed kernel is 7x7 with dilation 2 (7x7 with dilation 8), 49 taps instead of 2 * 9, and the
+        # zero padding of the intermediate map makes the pair differ from any single conv near the borders
         self.dia1 = nn.Conv2d(n_channels, n_channels, 3, 1, dilation=2, padding=get_pad(16, 3, 1, 2))
         self.dia2 = nn.Conv2d(n_channels, n_channels, 3, 1, dilation=4, padding=get_pad(16, 3, 1, 4))
 
@@ -239,7 +343,8 @@ class DenoiserUNet(nn.Module):
     """
 
     def __init__(self, input_channels: int = 2, output_channels: int = 1, n_channels: int = 32,
-                 ch_mults: Union[Tuple[int, ...], List[int]] = (1, 2, 2, 4), n_blocks: int = 2, is_noise: bool = True):
+                 ch_mults: Union[Tuple[int, ...], List[int]] = (1, 2, 2, 4), n_blocks: int = 2, is_noise: bool = True,
+                 channels_last: bool = False):
         """
         * `image_channels` is the number of channels in the image. $3$ for RGB.
         * `n_channels` is number of channels in the initial feature map that we transform the image into
@@ -250,6 +355,8 @@ class DenoiserUNet(nn.Module):
         ' is_attn '是一个布尔值列表，表示是否在每个resolution下使用注意力模块
         * `n_blocks` is the number of `UpDownBlocks` at each resolution
         ' n_blocks '是每个resolution下' UpDownBlocks '的数量
+        * `channels_last` stores the weights and activations in NHWC so cuDNN can use its Tensor Core kernels
+        ' channels_last '表示以NHWC格式存储权重和特征图
         """
         super().__init__()
 
@@ -282,6 +389,8 @@ class DenoiserUNet(nn.Module):
 
         # Combine the set of modules
         self.down = nn.ModuleList(down)
+        # One skip connection for the image projection plus one per module of the first half
+        self.n_skips = len(self.down) + 1
 
         # Middle block
         self.middle = MiddleBlock(out_channels, n_channels * 4, is_noise=False)
@@ -307,35 +416,50 @@ class DenoiserUNet(nn.Module):
         # Combine the set of modules
         self.up = nn.ModuleList(up)
 
-        self.act = Swish()
+        # The last feature map is not reused, so the activation can run in place
+        self.act = Swish(inplace=True)
         self.final = nn.Conv2d(in_channels, output_channels, kernel_size=(3, 3), padding=(1, 1))
 
-    def forward(self, x: torch.Tensor, t: torch.Tensor = torch.tensor([0]).cuda()):
+        self.channels_last = channels_last
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+
+    def forward(self, x: torch.Tensor, t: torch.Tensor = None):
         """
         * `x` has shape `[batch_size, in_channels, height, width]`
-        * `t` has shape `[batch_size]`
+        * `t` has shape `[batch_size]`, time step $0$ when not given
         """
+        # Run in the dtype of the weights (e.g. bf16) and hand the result back in the caller's dtype
+        dtype = x.dtype
+        x = x.to(self.image_proj.weight.dtype)
 
         # Get time-step embeddings
         if self.is_noise:
+            if t is None:
+                t = torch.zeros(x.shape[0], dtype=torch.long, device=x.device)
             t = self.time_emb(t)
         else:
             t = None
         # Get image projection
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         x = self.image_proj(x)
 
-        # `h` will store outputs at each resolution for skip connection
-        h = [x]
+        # `h` will store outputs at each resolution for skip connection.
+        # Fixed size and indexed, so the skip slots are the same on every call
+        h = [None] * self.n_skips
+        h[0] = x
         # First half of U-Net
-        for m in self.down:
+        for i, m in enumerate(self.down):
             x = m(x, t)
 
-            h.append(x)
+            h[i + 1] = x
 
         # Middle (bottom)
         x = self.middle(x, t)
 
         # Second half of U-Net
+        i = self.n_skips
         for m in self.up:
             if isinstance(m, Upsample):
                 x = m(x, t)
@@ -343,14 +467,50 @@ class DenoiserUNet(nn.Module):
                 # x = attention(x)
 
             else:
-                # Get the skip connection from first half of U-Net and concatenate
-                s = h.pop()
+                # Get the skip connection from first half of U-Net and concatenate, then release the slot
+                i -= 1
+                s, h[i] = h[i], None
 
                 x = torch.cat((x, s), dim=1)
                 x = m(x, t)
-        return self.final(self.act(x))
+        return self.final(self.act(x)).to(dtype)
+
+    def fold_norms(self):
+        """
+        For inference, fold the affine of every LayerNorm that feeds a 1x1 conv or linear layer directly into that layer.
+        The GroupNorms are followed by a Swish, so their affine cannot be folded.
+        This changes the `state_dict`, call it after loading the weights.
+        """
+        for m in self.modules():
+            if isinstance(m, MLP):
+                fold_norm_affine(m.fc[0], m.fc[1])
+            elif isinstance(m, (Intra_SA, Inter_SA)):
+                fold_norm_affine(m.attention_norm, m.conv_input)
+                fold_norm_affine(m.ffn_norm, m.ffn.fc1)
+        return self
+
+    def materialize_time_embedding(self, T: int):
+        """
+        Replace the time embedding by a lookup table over the `T` diffusion steps for inference.
+        Call it after any dtype cast: the table takes the dtype of the MLP weights, while the angles are still
+        computed from the fp32 frequencies
+        """
+        if self.is_noise:
+            self.time_emb.materialize(T)
+        return self
+
+    def quantize(self):
+        """
+        Dynamic int8 quantization of the `nn.Linear` layers inside the Stripformer blocks, which run on every token.
+        The time embedding linears only see one vector per sample and stay in floating point.
+        PyTorch's quantized kernels run on the CPU only.
+        """
+        for m in [m for m in self.modules() if isinstance(m, Stripformer)]:
+            torch.quantization.quantize_dynamic(m, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        return self
 
 
 def get_pad(in_, ksize, stride, atrous=1):
-    out_ = np.ceil(float(in_)/stride)
-    return int(((out_ - 1) * stride + atrous*(ksize-1) + 1 - in_)/2)
+    # 'same' padding in integer arithmetic, -(-a // b) is ceil(a / b)
+    out_ = -(-in_ // stride)
+    return max(((out_ - 1) * stride + atrous*(ksize-1) + 1 - in_) // 2, 0)
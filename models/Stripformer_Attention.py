@@ -52,12 +52,17 @@ class Attention(nn.Module):
         query_layer = self.transpose_for_scores(query_layer)
         key_layer = self.transpose_for_scores(key_layer)
         value_layer = self.transpose_for_scores(value_layer)
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-        _, _, _, d = query_layer.size()
-        # 此处的d就是函数transpose_for_scores中的attention_head_size
-        attention_scores = attention_scores / math.sqrt(d)
-        attention_probs = self.softmax(attention_scores)
-        context_layer = torch.matmul(attention_probs, value_layer)
+        if hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
+            # PyTorch >= 2.0：融合的SDPA会按dtype和形状自动选择FlashAttention或memory-efficient内核，
+            # 不会生成完整的N×N注意力矩阵，缩放系数同样是1/sqrt(d)
+            context_layer = torch.nn.functional.scaled_dot_product_attention(query_layer, key_layer, value_layer)
+        else:
+            attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+            _, _, _, d = query_layer.size()
+            # 此处的d就是函数transpose_for_scores中的attention_head_size
+            attention_scores = attention_scores / math.sqrt(d)
+            attention_probs = self.softmax(attention_scores)
+            context_layer = torch.matmul(attention_probs, value_layer)
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (C,)
         attention_out = context_layer.view(*new_context_layer_shape)
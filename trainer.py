@@ -58,6 +58,8 @@ class Trainer:
         self.mode = config.MODE
         self.schedule = Schedule(config.SCHEDULE, config.TIMESTEPS)
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
         in_channels = config.CHANNEL_X + config.CHANNEL_Y
         out_channels = config.CHANNEL_Y
         self.out_channels = out_channels
@@ -66,7 +68,8 @@ class Trainer:
             output_channels=out_channels,
             n_channels=config.MODEL_CHANNELS,
             ch_mults=config.CHANNEL_MULT,
-            n_blocks=config.NUM_RESBLOCKS
+            n_blocks=config.NUM_RESBLOCKS,
+            channels_last=config.CHANNELS_LAST == 'True'
         ).to(self.device)
         self.diffusion = GaussianDiffusion(self.network.denoiser, config.TIMESTEPS, self.schedule).to(self.device)
         self.test_img_save_path = config.TEST_IMG_SAVE_PATH
@@ -98,6 +101,10 @@ class Trainer:
         self.high_low_freq = config.HIGH_LOW_FREQ
         self.image_size = config.IMAGE_SIZE
         self.native_resolution = config.NATIVE_RESOLUTION
+        self.bf16 = config.BF16
+        self.quantize = config.QUANTIZE
+        self.jit = config.JIT
+        self.compile = config.COMPILE
 
         self.findmax = True
 
@@ -111,7 +118,7 @@ class Trainer:
             dataset_train = DocData(self.path_train_img, self.path_train_gt, config.IMAGE_SIZE, self.mode)
             self.batch_size = config.BATCH_SIZE
             self.dataloader_train = DataLoader(dataset_train, batch_size=self.batch_size, shuffle=True, drop_last=False,
-                                               num_workers=config.NUM_WORKERS)
+                                               num_workers=config.NUM_WORKERS, pin_memory=True)
         else:
             dataset_test = DocData(config.TEST_PATH_IMG, config.TEST_PATH_GT, config.IMAGE_SIZE, self.mode)
             self.dataloader_test = DataLoader(dataset_test, batch_size=config.BATCH_SIZE_VAL, shuffle=False,
@@ -120,6 +127,13 @@ class Trainer:
         if self.mode == 1 and config.EMA == 'True':
             self.EMA = EMA(0.9999)
             self.ema_model = copy.deepcopy(self.network).to(self.device)
+        # 在EMA拷贝之后再编译。整个去噪网络只编译一次，所有ResidualBlock在同一张图里，
+        # 不会因为各个block的输入形状不同而触发dynamo的重编译上限后退回eager
+        if config.COMPILE == 'True':
+            if hasattr(self.network.denoiser, 'compile'):
+                self.network.denoiser.compile(mode='max-autotune', dynamic=False)
+            else:
+                print('COMPILE needs nn.Module.compile (PyTorch >= 2.2), the denoiser runs in eager mode')
         if config.LOSS == 'L1':
             self.loss = nn.L1Loss()
         elif config.LOSS == 'L2':
@@ -172,6 +186,19 @@ class Trainer:
                 print(f"{name}: {param.dtype}")
             '''
             self.network.eval()
+            # 把紧接1x1卷积/全连接层的LayerNorm仿射参数折叠进该层
+            self.network.denoiser.fold_norms()
+            if self.bf16 == 'True':
+                # 推理时去噪网络整体以bf16运行，输入输出仍为fp32
+                self.network.denoiser.to(dtype=torch.bfloat16)
+            elif self.quantize == 'True':
+                if self.device.type == 'cpu':
+                    # Stripformer中的全连接层使用int8动态量化
+                    self.network.denoiser.quantize()
+                else:
+                    print('QUANTIZE only works on the CPU, the denoiser is not quantized')
+            # 时间步是离散的，推理时时间步嵌入直接查表
+            self.network.denoiser.materialize_time_embedding(self.num_timesteps)
             tq = tqdm(self.dataloader_test)
             sampler = self.diffusion
             iteration = 0
@@ -193,12 +220,21 @@ class Trainer:
                     img = crop_concat(img)
                 noisyImage = torch.randn_like(img).to(self.device)
                 init_predict = self.network.init_predictor(img.to(self.device), 0)[-1]
+                if self.jit == 'True' and iteration == 1:
+                    if self.compile == 'True':
+                        # torch.jit.trace不能trace已经被dynamo编译过的模型
+                        print('JIT is ignored because COMPILE is on, the denoiser is already compiled')
+                    else:
+                        # 用第一个batch trace去噪网络，冻结参数并融合算子，去掉逐个block的Python调度开销
+                        example = (torch.cat((noisyImage, init_predict), dim=1),
+                                   torch.zeros(noisyImage.shape[0], dtype=torch.long, device=self.device))
+                        sampler.model = torch.jit.optimize_for_inference(torch.jit.trace(self.network.denoiser, example))
 
                 if self.DPM_SOLVER == 'True':
                     sampledImgs = dpm_solver(self.schedule.get_betas(), self.network,
                                              torch.cat((noisyImage, img.to(self.device)), dim=1), self.DPM_STEP)
                 else:
-                    sampledImgs = sampler(noisyImage.cuda(), init_predict, self.pre_ori)
+                    sampledImgs = sampler(noisyImage, init_predict, self.pre_ori)
                 finalImgs = (sampledImgs + init_predict)
                 if self.native_resolution == 'True':
                     finalImgs = crop_concat_back(temp, finalImgs)
@@ -238,6 +274,8 @@ class Trainer:
         optimizer = optim.AdamW(self.network.parameters(), lr=self.LR, weight_decay=1e-4)
         iteration = self.continue_training_steps
         save_img_path = init__result_Dir()
+        # 训练时裁剪尺寸固定，让cuDNN为每个卷积挑选最快的算法
+        torch.backends.cudnn.benchmark = True
         print('Starting Training', f"Step is {self.num_timesteps}")
 
         while iteration < self.iteration_max:
@@ -249,11 +287,13 @@ class Trainer:
                 self.network.train()
                 optimizer.zero_grad()
 
-                t = torch.randint(0, self.num_timesteps, (img.shape[0],)).long().to(self.device)
-                init_predict, noise_pred, noisy_image, noise_ref, init_predict_list = self.network(gt.to(self.device), img.to(self.device), t, self.diffusion)
-                gt_img = gt.to(self.device)
-                gt_img2 = F.interpolate(gt.to(self.device), scale_factor=0.5, mode='bilinear')
-                gt_img4 = F.interpolate(gt.to(self.device), scale_factor=0.25, mode='bilinear')
+                # 每个batch只做一次非阻塞的H2D拷贝（DataLoader使用了pin_memory），时间步直接在GPU上生成
+                gt_img = gt.to(self.device, non_blocking=True)
+                blur_img = img.to(self.device, non_blocking=True)
+                t = torch.randint(0, self.num_timesteps, (img.shape[0],), device=self.device)
+                init_predict, noise_pred, noisy_image, noise_ref, init_predict_list = self.network(gt_img, blur_img, t, self.diffusion)
+                gt_img2 = F.interpolate(gt_img, scale_factor=0.5, mode='bilinear')
+                gt_img4 = F.interpolate(gt_img, scale_factor=0.25, mode='bilinear')
                 l1 = criterion(init_predict_list[0], gt_img4)
                 l2 = criterion(init_predict_list[1], gt_img2)
                 l3 = criterion(init_predict_list[2], gt_img)
@@ -271,20 +311,20 @@ class Trainer:
 
                 if self.pre_ori == 'True':
                     if self.high_low_freq == 'True':
-                        residual_high = self.high_filter(gt.to(self.device) - init_predict)
-                        ddpm_loss = 2*self.loss(self.high_filter(noise_pred), residual_high) + self.loss(noise_pred, gt.to(self.device) - init_predict)
+                        residual_high = self.high_filter(gt_img - init_predict)
+                        ddpm_loss = 2*self.loss(self.high_filter(noise_pred), residual_high) + self.loss(noise_pred, gt_img - init_predict)
                     else:
-                        ddpm_loss = self.loss(noise_pred, gt.to(self.device) - init_predict)
+                        ddpm_loss = self.loss(noise_pred, gt_img - init_predict)
                 else:
                     ddpm_loss = self.loss(noise_pred, noise_ref.to(self.device))
                 if self.high_low_freq == 'True':
-                    low_high_loss = self.loss(init_predict, gt.to(self.device))
-                    low_freq_loss = self.loss(init_predict - self.high_filter(init_predict), gt.to(self.device) - self.high_filter(gt.to(self.device)))
+                    low_high_loss = self.loss(init_predict, gt_img)
+                    low_freq_loss = self.loss(init_predict - self.high_filter(init_predict), gt_img - self.high_filter(gt_img))
                     pixel_loss = low_high_loss + 2*low_freq_loss
                 else:
-                    pixel_loss = self.loss(init_predict, gt.to(self.device))
+                    pixel_loss = self.loss(init_predict, gt_img)
 
-                psnr_loss = calculate_psnr(gt.to(self.device), noise_pred + init_predict)
+                psnr_loss = calculate_psnr(gt_img, noise_pred + init_predict)
 
                 loss = 0.75 * (ddpm_loss + self.beta_loss * (pixel_loss) / self.num_timesteps) + loss_content + 0.1 * loss_fft
                 # loss = ddpm_loss + self.beta_loss * (pixel_loss) / self.num_timesteps